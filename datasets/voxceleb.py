@@ -34,7 +34,7 @@ class VoxCelebPartition(SimDatasetPartition):
             else:
                 batch.append(segment)
         batch = torch.stack(batch, dim=0)
-        return batch, torch.Tensor(dic['y']).long()
+        return batch, torch.as_tensor(dic['y'], dtype=torch.long)
 
 
 class VoxCelebDataset(SimDataset):
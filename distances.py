@@ -1,7 +1,40 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import math
+import numpy as np
 import torch
 import torch.nn.functional as F
+try:
+    from numba import njit, prange
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+
+if _NUMBA_AVAILABLE:
+
+    @njit(parallel=True, cache=True)
+    def _cosine_pdist_nb(x, out):
+        """
+        Write the condensed cosine distance matrix of a batch into `out`
+        :param x: a contiguous array of shape (N, d)
+        :param out: a preallocated array of size N * (N - 1) / 2
+        """
+        n, d = x.shape
+        norms = np.empty(n, dtype=x.dtype)
+        for i in prange(n):
+            s = 0.
+            for k in range(d):
+                s += x[i, k] * x[i, k]
+            norms[i] = max(math.sqrt(s), 1e-8)
+        for i in prange(n - 1):
+            # Position of the pair (i, i+1) in the condensed matrix
+            offset = i * n - i * (i + 1) // 2
+            for j in range(i + 1, n):
+                s = 0.
+                for k in range(d):
+                    s += x[i, k] * x[j, k]
+                out[offset + j - i - 1] = 1. - s / (norms[i] * norms[j])
 
 
 class Distance:
@@ -12,6 +45,20 @@ class Distance:
     def dist(self, x, y):
         raise NotImplementedError("a Distance should implement 'dist'")
     
+    def paired_dist(self, x, y):
+        """
+        Calculate the distance between 2 batches, element by element, as scikit-learn
+            does with the metric returned by 'to_sklearn_metric'
+        :param x: a tensor of shape (N, d), where
+            N = batch size
+            d = feature dimension
+        :param y: a tensor of shape (N, d), where
+            N = batch size
+            d = feature dimension
+        :return: a 1D tensor of size N with the distances
+        """
+        raise NotImplementedError("a Distance should implement 'paired_dist'")
+
     def pdist(self, x):
         """
         Calculate the pairwise distance for a given batch
@@ -22,6 +69,16 @@ class Distance:
         """
         raise NotImplementedError("a Distance should implement 'pdist'")
     
+    def pdist_matrix(self, x):
+        """
+        Calculate the pairwise distance for a given batch as a square matrix
+        :param x: a tensor of shape (N, d), where
+            N = batch size
+            d = feature dimension
+        :return: a tensor of shape (N, N) corresponding to the full distance matrix
+        """
+        raise NotImplementedError("a Distance should implement 'pdist_matrix'")
+    
     def sqdist_sum(self, x, y):
         """
         Calculate the squared distance between 2 batches and then return the sum
@@ -46,7 +103,7 @@ class Distance:
 
 class CosineDistance(Distance):
     """
-    Cosine distance module using PyTorch's cosine_similarity to calculate pdist
+    Cosine distance module using a normalized matrix product to calculate pdist
     """
     
     def __init__(self):
@@ -60,20 +117,33 @@ class CosineDistance(Distance):
 
     def dist(self, x, y):
         return 1 - F.cosine_similarity(x, y, dim=1, eps=1e-8)
+
+    def paired_dist(self, x, y):
+        return self.dist(x, y)
     
     def sqdist_sum(self, x, y):
         d = self.dist(x, y)
-        return d.pow(2).sum()
+        # Sum of squares as a single reduction, without materializing d²
+        return torch.dot(d, d)
+    
+    def pdist_matrix(self, x):
+        # Cosine similarity of every pair as a single matrix product of the normalized batch
+        xnorm = F.normalize(x, dim=1, eps=1e-8)
+        return 1. - torch.mm(xnorm, xnorm.t())
     
     def pdist(self, x):
         nbatch, _ = x.size()
-        distances = []
-        for i in range(nbatch-1):
-            d = 1. - F.cosine_similarity(
-                x[i, :].expand(nbatch - 1 - i, -1),
-                x[i+1:, :], dim=1, eps=1e-8)
-            distances.append(d)
-        return torch.cat(distances)
+        numba_path = (_NUMBA_AVAILABLE and x.device.type == 'cpu' and x.dtype in (torch.float32, torch.float64)
+                      and not (x.requires_grad and torch.is_grad_enabled()))
+        if numba_path:
+            # No gradient needed, compute the condensed matrix directly on CPU
+            xnp = x.detach().contiguous().numpy()
+            out = np.empty(nbatch * (nbatch - 1) // 2, dtype=xnp.dtype)
+            _cosine_pdist_nb(xnp, out)
+            return torch.from_numpy(out)
+        # Keep the upper triangle to match the condensed format
+        iu, ju = torch.triu_indices(nbatch, nbatch, offset=1, device=x.device)
+        return self.pdist_matrix(x)[iu, ju]
 
 
 class EuclideanDistance(Distance):
@@ -93,9 +163,19 @@ class EuclideanDistance(Distance):
 
     def dist(self, x, y):
         return torch.sum(torch.pow((x - y), 2), dim=1)
+
+    def paired_dist(self, x, y):
+        # 'dist' is the squared euclidean distance
+        return self.dist(x, y).sqrt()
     
     def sqdist_sum(self, x, y):
-        return (x - y).pow(2).sum()
+        diff = (x - y).reshape(-1)
+        return torch.dot(diff, diff)
+    
+    def pdist_matrix(self, x):
+        # Exact differences like F.pdist, cdist's matrix product shortcut loses precision for large norms.
+        # Unlike F.pdist, cdist has a safe gradient for null distances, which are always on the diagonal
+        return torch.cdist(x, x, compute_mode='donot_use_mm_for_euclid_dist')
     
     def pdist(self, x):
         return F.pdist(x)
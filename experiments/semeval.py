@@ -1,4 +1,3 @@
-from scipy.stats import spearmanr
 from models import SemanticNet
 from distances import Distance
 from core.plugins.storage import ModelLoader
@@ -7,7 +6,7 @@ from losses.wrappers import STSBaselineClassifier
 from datasets.semeval import SemEval, SemEvalPartitionFactory
 from sts.augmentation import NoAugmentation
 from sts.modes import STSForwardMode, PairSTSForwardMode, ConcatSTSForwardMode
-from metrics import STSEmbeddingEvaluator, STSBaselineEvaluator, DistanceSpearmanMetric, LogitsSpearmanMetric
+from metrics import STSEmbeddingEvaluator, STSBaselineEvaluator, DistanceSpearmanMetric, LogitsSpearmanMetric, spearman
 from experiments.base import ModelEvaluationExperiment
 from common import DEVICE
 import visual_utils
@@ -132,5 +131,5 @@ class SemEvalPredictionsSpearmanExperiment:
         other_evaluator = self.exp_other.get_dev_evaluator()
         _, feat_baseline, _ = baseline_evaluator.eval(self.exp_baseline.model)
         _, feat_other, _ = other_evaluator.eval(self.exp_other.model)
-        return spearmanr(baseline_evaluator.metric.predictions, other_evaluator.metric.similarity)[0]
+        return spearman(baseline_evaluator.metric.scores(), other_evaluator.metric.scores())
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -13,9 +14,10 @@ class ArcLinear(nn.Module):
     :param nclass: the number of classes
     :param margin: the margin to separate classes in angular space
     :param s: the scaling factor for the feature vector
+    :param bf16: whether to compute the cosines in bfloat16 when running on a GPU that supports it
     """
     
-    def __init__(self, nfeat, nclass, margin, s):
+    def __init__(self, nfeat, nclass, margin, s, bf16=False):
         super(ArcLinear, self).__init__()
         eps = 1e-4
         self.min_cos = eps - 1
@@ -23,8 +25,41 @@ class ArcLinear(nn.Module):
         self.nclass = nclass
         self.margin = margin
         self.s = s
+        self.bf16 = bf16
+        # Whether each CUDA device supports bfloat16, resolved the first time it's used
+        self._bf16_supported = {}
+        # Precompute the margin terms for cos(θ + m) = cosθ·cos(m) - sinθ·sin(m)
+        self.cos_m = math.cos(margin)
+        self.sin_m = math.sin(margin)
         self.W = nn.Parameter(torch.Tensor(nclass, nfeat))
         nn.init.xavier_uniform_(self.W)
+        # Normalized W reused between evaluation batches, tagged with the W storage and version it comes from
+        self._Wnorm_cache, self._Wnorm_key = None, None
+
+    def _normalized_weights(self):
+        """
+        Normalize W, reusing the last result while evaluating if W hasn't changed since
+        :return: a tensor of shape (nclass, nfeat) with unit norm rows
+        """
+        if self.training or torch.is_grad_enabled():
+            return F.normalize(self.W)
+        key = (self.W.data_ptr(), self.W._version)
+        if key != self._Wnorm_key:
+            self._Wnorm_cache, self._Wnorm_key = F.normalize(self.W.detach()), key
+        return self._Wnorm_cache
+
+    def _use_bf16(self, x):
+        """
+        Check whether the cosines of a batch should be computed in bfloat16
+        :param x: a feature vector batch
+        :return: True if bf16 was requested and the device of x supports it
+        """
+        if not (self.bf16 and x.is_cuda):
+            return False
+        if x.device not in self._bf16_supported:
+            with torch.cuda.device(x.device):
+                self._bf16_supported[x.device] = torch.cuda.is_bf16_supported()
+        return self._bf16_supported[x.device]
     
     def forward(self, x, y):
         """
@@ -35,23 +70,25 @@ class ArcLinear(nn.Module):
         """
         # Normalize the feature vectors and W
         xnorm = F.normalize(x)
-        Wnorm = F.normalize(self.W)
+        Wnorm = self._normalized_weights()
         y = y.long().view(-1, 1)
         # Calculate cosθj (the logits)
-        cos_theta_j = torch.matmul(xnorm, torch.transpose(Wnorm, 0, 1))
+        if self._use_bf16(x):
+            # Halve the memory traffic of the matmul, the margin is then applied in float32
+            cos_theta_j = F.linear(xnorm.bfloat16(), Wnorm.bfloat16()).float()
+        else:
+            cos_theta_j = F.linear(xnorm, Wnorm)
         # Get the cosθ corresponding to the classes
         cos_theta_yi = cos_theta_j.gather(1, y)
         # For numerical stability
         cos_theta_yi = cos_theta_yi.clamp(min=self.min_cos, max=self.max_cos)
-        # Get the angle separating xi and Wyi
-        theta_yi = torch.acos(cos_theta_yi)
-        # Apply the margin to the angle
-        cos_theta_yi_margin = torch.cos(theta_yi + self.margin)
-        # One hot encode  y
-        one_hot = torch.zeros_like(cos_theta_j)
-        one_hot.scatter_(1, y, 1.0)
-        # Project margin differences into cosθj
-        cos_theta_j += one_hot * (cos_theta_yi_margin - cos_theta_yi)
+        # Get the sine of the angle separating xi and Wyi (θ is in [0, π], so sinθ >= 0)
+        sin_theta_yi = torch.sqrt(1 - cos_theta_yi * cos_theta_yi)
+        # Apply the margin to the angle without going through acos/cos
+        cos_theta_yi_margin = cos_theta_yi * self.cos_m - sin_theta_yi * self.sin_m
+        # Project margin differences into cosθj, only at the target class of each row.
+        # Out of place: cosθj was saved by gather for the backward pass
+        cos_theta_j = cos_theta_j.scatter_add(1, y, cos_theta_yi_margin - cos_theta_yi)
         # Apply the scaling
         cos_theta_j = self.s * cos_theta_j
         return cos_theta_j
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from torch import nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
 from distances import CosineDistance, EuclideanDistance
@@ -8,7 +9,7 @@ from losses.wrappers import LossWrapper, STSBaselineClassifier
 from losses.arcface import ArcLinear
 from losses.coco import CocoLinear
 from losses.contrastive import ContrastiveLoss
-from losses.triplet import TripletLoss, BatchAll
+from losses.triplet import TripletLoss
 import core.base as base
 
 
@@ -68,9 +69,9 @@ class SoftmaxConfig(LossConfig):
 
 class ArcFaceConfig(LossConfig):
 
-    def __init__(self, device, nfeat, nclass, margin=0.2, s=7.0):
-        self.loss_module = ArcLinear(nfeat, nclass, margin, s)
-        loss = LossWrapper(nn.CrossEntropyLoss().to(device))
+    def __init__(self, device, nfeat, nclass, margin=0.2, s=7.0, bf16=False):
+        self.loss_module = ArcLinear(nfeat, nclass, margin, s, bf16)
+        loss = LossWrapper(F.cross_entropy)
         super(ArcFaceConfig, self).__init__('ArcFace Loss', f"m={margin} s={s}", self.loss_module, loss, CosineDistance())
 
     def optimizer(self, model, task, lr):
@@ -166,7 +167,7 @@ class ContrastiveConfig(LossConfig):
 class TripletConfig(LossConfig):
 
     def __init__(self, device, margin: float = 2, distance=EuclideanDistance(),
-                 size_average: bool = True, online: bool = True, sampling=BatchAll()):
+                 size_average: bool = True, online: bool = True, sampling=None):
         loss = TripletLoss(device, margin, distance, size_average, online, sampling)
         super(TripletConfig, self).__init__('Triplet Loss', f"m={margin} - {distance}", None, loss, distance)
 
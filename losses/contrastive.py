@@ -35,13 +35,13 @@ class ContrastiveLoss(nn.Module):
         if self.online:
             # First calculate the (euclidean) distances between every sample in the batch
             nbatch = feat.size(0)
-            dist = self.distance.pdist(feat).to(self.device)
+            dist = self.distance.pdist(feat)
             # Calculate the ground truth Y corresponding to the pairs
             gt = []
             for i in range(nbatch-1):
                 for j in range(i+1, nbatch):
                     gt.append(int(y[i] != y[j]))
-            gt = torch.Tensor(gt).float().to(self.device)
+            gt = torch.Tensor(gt).float().to(dist.device)
         else:
             feat1, feat2 = feat
             dist = self.distance.dist(feat1, feat2)
@@ -1,22 +1,29 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 from distances import Distance
-from scipy.spatial.distance import squareform
-from pyannote.core.utils.distance import to_condensed
 
 
 class TripletSamplingStrategy:
+    """
+    A triplet sampling strategy
+    :attr uses_distances: whether the sampled triplets depend on the distances and not only on the labels
+    :attr reuses_triplets: whether the strategy already reuses its own triplets from one batch to the next
+    """
+
+    uses_distances = True
+    reuses_triplets = False
     
     def triplets(self, y, distances):
         """
         Sample triplets from batch x according to labels y
         :param y: non one-hot labels for the current batch
-        :param distances: a condensed distance matrix for the current batch
-        :return: a tuple (anchors, positives, negatives) corresponding to the triplets built
+        :param distances: a square distance matrix for the current batch
+        :return: a tuple of long tensors (anchors, positives, negatives) corresponding to the triplets built,
+            on the same device as the distances
         """
         raise NotImplementedError("a TripletSamplingStrategy should implement 'triplets'")
 
@@ -24,23 +31,73 @@ class TripletSamplingStrategy:
 class BatchAll(TripletSamplingStrategy):
     """
     Batch all strategy. Create every possible triplet for a given batch
+    :param pk: an optional pair (P, K) for batches made of P classes with K consecutive samples each.
+        In that case triplet indices only depend on positions, so they are computed once and reused.
+        Every batch is checked to follow this layout, asynchronously when labels are on a GPU
     """
 
-    def triplets(self, y, distances):
-        anchors, positives, negatives = [], [], []
-        for anchor, y_anchor in enumerate(y):
-            for positive, y_positive in enumerate(y):
-                # if same embedding or different labels, skip
-                if (anchor == positive) or (y_anchor != y_positive):
-                    continue
-                for negative, y_negative in enumerate(y):
-                    if y_negative == y_anchor:
-                        continue
-                    anchors.append(anchor)
-                    positives.append(positive)
-                    negatives.append(negative)
+    uses_distances = False
+
+    def __init__(self, pk: tuple = None):
+        self.pk = pk
+        self._mask = None
+        self._pk_triplets = None
+
+    @property
+    def reuses_triplets(self):
+        return self.pk is not None
+
+    def _mask_buffer(self, n, device):
+        """
+        Get a (n, n, n) boolean buffer for the triplet mask, reusing the previous one if possible
+        :param n: the batch size
+        :param device: the device of the labels
+        :return: an uninitialized boolean tensor of shape (n, n, n)
+        """
+        if self._mask is None or self._mask.size(0) != n or self._mask.device != device:
+            self._mask = torch.empty(n, n, n, dtype=torch.bool, device=device)
+        return self._mask
+
+    def _all_triplets(self, y):
+        n = y.size(0)
+        same = y.unsqueeze(0) == y.unsqueeze(1)
+        positive_pairs = same.clone().fill_diagonal_(False)
+        # mask[a, p, n] is True iff (a, p) is a positive pair and (a, n) a negative pair
+        mask = self._mask_buffer(n, y.device)
+        torch.logical_and(positive_pairs.unsqueeze(2), (~same).unsqueeze(1), out=mask)
+        anchors, positives, negatives = mask.nonzero(as_tuple=True)
         return anchors, positives, negatives
 
+    def _pk_template(self, device):
+        """
+        Get the triplets of a P-K batch, computing them the first time
+        :param device: the device of the labels
+        :return: a tuple of long tensors (anchors, positives, negatives)
+        """
+        if self._pk_triplets is None or self._pk_triplets[0].device != device:
+            p, k = self.pk
+            self._pk_triplets = self._all_triplets(torch.arange(p, device=device).repeat_interleave(k))
+        return self._pk_triplets
+
+    def triplets(self, y, distances):
+        # Build indices where the distances live, so fetching them needs no copy
+        y = y.to(distances.device)
+        if self.pk is None:
+            return self._all_triplets(y)
+        p, k = self.pk
+        if y.size(0) != p * k:
+            raise ValueError(f"BatchAll expected a batch of {p} x {k} samples, got {y.size(0)}")
+        grouped = y.view(p, k)
+        heads = grouped[:, 0]
+        distinct = (heads.unsqueeze(0) != heads.unsqueeze(1)) | torch.eye(p, dtype=torch.bool, device=y.device)
+        grouped_ok = (grouped == grouped[:, :1]).all() & distinct.all()
+        if y.is_cuda:
+            # Fails on the device without waiting for the result, a wrong layout would silently give wrong triplets
+            torch._assert_async(grouped_ok)
+        elif not grouped_ok:
+            raise ValueError(f"BatchAll expected {p} groups of {k} consecutive samples with the same label")
+        return self._pk_template(y.device)
+
 
 class SemiHardNegative(TripletSamplingStrategy):
     """
@@ -52,22 +109,17 @@ class SemiHardNegative(TripletSamplingStrategy):
         self.n = n
 
     def triplets(self, y, distances):
-        anchors, positives, negatives = [], [], []
-        distances = squareform(distances.detach().cpu().numpy())
-        y = y.cpu().numpy()
-        for anchor, y_anchor in enumerate(y):
-            # hardest negative
-            d = distances[anchor]
-            neg = np.where(y != y_anchor)[0]
-            semihard_negatives = d[neg].argsort()[:self.n]
-            for negative in semihard_negatives:
-                for positive in np.where(y == y_anchor)[0]:
-                    if positive == anchor:
-                        continue
-                    anchors.append(anchor)
-                    positives.append(positive)
-                    negatives.append(negative)
-        return anchors, positives, negatives
+        y = y.to(distances.device)
+        nbatch = y.size(0)
+        distances = distances.detach()
+        same = y.unsqueeze(0) == y.unsqueeze(1)
+        pos_mask = same & ~torch.eye(nbatch, dtype=torch.bool, device=y.device)
+        # semi-hard negatives: the `n` closest negatives of each anchor
+        d_neg, semihard = distances.masked_fill(same, float('inf')).topk(min(self.n, nbatch), dim=1, largest=False)
+        # mask[a, k, p] is True iff the k-th closest sample of a is a negative and (a, p) a positive pair
+        mask = (d_neg != float('inf')).unsqueeze(2) & pos_mask.unsqueeze(1)
+        anchors, ranks, positives = mask.nonzero(as_tuple=True)
+        return anchors, positives, semihard[anchors, ranks]
 
 
 class HardestNegative(TripletSamplingStrategy):
@@ -77,21 +129,17 @@ class HardestNegative(TripletSamplingStrategy):
     """
 
     def triplets(self, y, distances):
-        anchors, positives, negatives = [], [], []
-        distances = squareform(distances.detach().cpu().numpy())
-        y = y.cpu().numpy()
-        for anchor, y_anchor in enumerate(y):
-            # hardest negative
-            d = distances[anchor]
-            neg = np.where(y != y_anchor)[0]
-            negative = int(neg[np.argmin(d[neg])])
-            for positive in np.where(y == y_anchor)[0]:
-                if positive == anchor:
-                    continue
-                anchors.append(anchor)
-                positives.append(positive)
-                negatives.append(negative)
-        return anchors, positives, negatives
+        y = y.to(distances.device)
+        n = y.size(0)
+        distances = distances.detach()
+        same = y.unsqueeze(0) == y.unsqueeze(1)
+        not_self = ~torch.eye(n, dtype=torch.bool, device=y.device)
+        # hardest negative
+        negative = distances.masked_fill(same, float('inf')).argmin(dim=1)
+        # every positive of every anchor that has at least one negative
+        mask = same & not_self & (~same).any(dim=1, keepdim=True)
+        anchors, positives = mask.nonzero(as_tuple=True)
+        return anchors, positives, negative[anchors]
     
     
 class HardestPositiveNegative(TripletSamplingStrategy):
@@ -103,23 +151,18 @@ class HardestPositiveNegative(TripletSamplingStrategy):
     """
 
     def triplets(self, y, distances):
-        anchors, positives, negatives = [], [], []
-        distances = squareform(distances.detach().cpu().numpy())
-        y = y.cpu().numpy()
-        for anchor, y_anchor in enumerate(y):
-            d = distances[anchor]
-            # hardest positive
-            pos = np.where(y == y_anchor)[0]
-            pos = [p for p in pos if p != anchor]
-            # hardest negative
-            neg = np.where(y != y_anchor)[0]
-            if d[pos].size > 0 and d[neg].size > 0:
-                positive = int(pos[np.argmax(d[pos])])
-                negative = int(neg[np.argmin(d[neg])])
-                anchors.append(anchor)
-                positives.append(positive)
-                negatives.append(negative)
-        return anchors, positives, negatives
+        y = y.to(distances.device)
+        n = y.size(0)
+        distances = distances.detach()
+        same = y.unsqueeze(0) == y.unsqueeze(1)
+        pos_mask = same & ~torch.eye(n, dtype=torch.bool, device=y.device)
+        # hardest positive
+        positive = distances.masked_fill(~pos_mask, float('-inf')).argmax(dim=1)
+        # hardest negative
+        negative = distances.masked_fill(same, float('inf')).argmin(dim=1)
+        # only keep anchors having both positives and negatives
+        anchors = (pos_mask.any(dim=1) & (~same).any(dim=1)).nonzero(as_tuple=True)[0]
+        return anchors, positive[anchors], negative[anchors]
     
 
 class TripletLoss(nn.Module):
@@ -129,18 +172,44 @@ class TripletLoss(nn.Module):
     :param device: a device in which to run the computation
     :param margin: a margin value to separe classes
     :param distance: a distance object to measure between the samples
-    :param sampling: a TripletSamplingStrategy
+    :param sampling: a TripletSamplingStrategy, a new BatchAll by default
+    :param cache_size: the maximum number of label patterns for which to keep triplet indices,
+        only used if the sampling strategy depends solely on the labels. Disabled by default,
+        as building the cache key copies the labels to the host at every step
     """
 
     def __init__(self, device: str, margin: float, distance: Distance,
-                 size_average: bool, online: bool = True, sampling=BatchAll()):
+                 size_average: bool, online: bool = True, sampling=None, cache_size: int = 0):
         super(TripletLoss, self).__init__()
         self.device = device
         self.margin = margin
         self.distance = distance
         self.size_average = size_average
         self.online = online
-        self.sampling = sampling
+        self.sampling = sampling if sampling is not None else BatchAll()
+        self.cache_size = cache_size
+        self._triplet_cache = OrderedDict()
+
+    def _triplets(self, y, dist):
+        """
+        Sample triplets, reusing them if this label pattern was already seen
+        :param y: a non one-hot label tensor corresponding to the batch
+        :param dist: the square distance matrix for the batch
+        :return: a tuple of long tensors (anchors, positives, negatives)
+        """
+        cacheable = self.cache_size > 0 and not (self.sampling.uses_distances or self.sampling.reuses_triplets)
+        if cacheable:
+            key = y.cpu().numpy().tobytes()
+            if key in self._triplet_cache:
+                self._triplet_cache.move_to_end(key)
+                return self._triplet_cache[key]
+        # Sample triplets according to the chosen strategy
+        triplets = self.sampling.triplets(y, dist)
+        if cacheable:
+            self._triplet_cache[key] = triplets
+            if len(self._triplet_cache) > self.cache_size:
+                self._triplet_cache.popitem(last=False)
+        return triplets
     
     def _calculate_distances(self, x, y):
         """
@@ -151,17 +220,12 @@ class TripletLoss(nn.Module):
         :param y: a non one-hot label tensor corresponding to the batch
         :return: a pair (distances to positives, distances to negatives)
         """
-        # Batch size
-        n = x.size(0)
         # Calculate distances between every sample in the batch
-        dist = self.distance.pdist(x).to(self.device)
+        dist = self.distance.pdist_matrix(x)
         # Sample triplets according to the chosen strategy
-        anchors, positives, negatives = self.sampling.triplets(y, dist)
-        # Condense indices so we can fetch distances using the condensed triangular matrix (less memory footprint)
-        pos = to_condensed(n, anchors, positives)
-        neg = to_condensed(n, anchors, negatives)
+        anchors, positives, negatives = self._triplets(y, dist)
         # Fetch the distances to positives and negatives
-        return dist[pos], dist[neg]
+        return dist[anchors, positives], dist[anchors, negatives]
     
     def forward(self, feat, logits, y):
         """
@@ -184,5 +248,5 @@ class TripletLoss(nn.Module):
             dneg = self.distance.dist(anchors, negatives)
 
         # Calculate the loss using the margin
-        loss = F.relu(torch.pow(dpos, 2) - torch.pow(dneg, 2) + self.margin)
+        loss = F.relu(dpos * dpos - dneg * dneg + self.margin)
         return loss.mean() if self.size_average else loss.sum()
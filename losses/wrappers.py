@@ -3,6 +3,10 @@ import torch.nn as nn
 
 
 class LossWrapper(nn.Module):
+    """
+    Adapt a loss on logits to the (feat, logits, y) signature
+    :param loss: a loss module or function taking (logits, y)
+    """
     
     def __init__(self, loss):
         super(LossWrapper, self).__init__()
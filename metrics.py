@@ -1,17 +1,39 @@
+from contextlib import nullcontext
 import torch
 import numpy as np
 from sklearn.neighbors import KNeighborsClassifier
-from scipy.stats import spearmanr
+from scipy.stats import rankdata
 from pyannote.audio.embedding.extraction import SequenceEmbedding
 from pyannote.database import get_protocol, get_unique_identifier
 from pyannote.metrics.binary_classification import det_curve
-from pyannote.core.utils.distance import cdist
 from pyannote.core import Timeline
 from distances import Distance
 import core.base as base
 import common
 
 
+def spearman(x, y) -> float:
+    """
+    Spearman rank correlation between 2 1D arrays, without the p-value that scipy's spearmanr calculates
+    :param x: a 1D array
+    :param y: a 1D array of the same size
+    :return: the Spearman correlation coefficient
+    """
+    return np.corrcoef(rankdata(x), rankdata(y))[0, 1]
+
+
+def eval_autocast(device, enabled: bool):
+    """
+    Get a context to run an evaluation forward pass in bfloat16 mixed precision
+    :param device: the device where the model runs
+    :param enabled: whether to use mixed precision. It's only used on GPU
+    :return: an autocast context if mixed precision should be used, a context doing nothing otherwise
+    """
+    if enabled and torch.device(device).type == 'cuda':
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+    return nullcontext()
+
+
 class Metric:
 
     def fit(self, embeddings, y):
@@ -37,7 +59,9 @@ class KNNAccuracyMetric(Metric):
     """
 
     def __init__(self, distance):
-        self.knn = KNeighborsClassifier(n_neighbors=1, metric=distance.to_sklearn_metric())
+        # Brute force lets sklearn compute distances with vectorized pairwise_distances
+        self.knn = KNeighborsClassifier(n_neighbors=1, metric=distance.to_sklearn_metric(),
+                                        algorithm='brute', n_jobs=-1)
         self.correct, self.total = 0, 0
 
     def fit(self, embeddings, y):
@@ -76,26 +100,26 @@ class LogitsAccuracyMetric(Metric):
 class LogitsSpearmanMetric(Metric):
 
     def __init__(self):
+        # Similarity scores associated to each of the 6 classes
+        self.class_scores = np.arange(6, dtype=np.float32)
         self.predictions, self.targets = [], []
 
     def fit(self, embeddings, y):
         pass
 
     def calculate_batch(self, embeddings, logits, y):
-        output = np.exp(logits)
-        predicted = []
-        for i in range(output.shape[0]):
-            predicted.append(0 * output[i, 0] +
-                             1 * output[i, 1] +
-                             2 * output[i, 2] +
-                             3 * output[i, 3] +
-                             4 * output[i, 4] +
-                             5 * output[i, 5])
-        self.predictions.extend(predicted)
-        self.targets.extend(list(y))
+        # Expected score under the predicted class distribution
+        self.predictions.append(np.exp(logits).dot(self.class_scores))
+        self.targets.append(np.asarray(y))
+
+    def scores(self):
+        """
+        :return: a 1D array with the predicted scores accumulated since the last call to 'get'
+        """
+        return np.concatenate(self.predictions)
 
     def get(self):
-        metric = spearmanr(self.predictions, self.targets)[0]
+        metric = spearman(self.scores(), np.concatenate(self.targets))
         self.predictions, self.targets = [], []
         return metric
 
@@ -111,12 +135,18 @@ class DistanceSpearmanMetric(Metric):
 
     def calculate_batch(self, embeddings, logits, y):
         embeddings1, embeddings2 = embeddings
-        self.similarity.extend([-self.distance.dist(embeddings1[i,:].unsqueeze(0), embeddings2[i,:].unsqueeze(0))
-                                for i in range(embeddings1.size(0))])
-        self.targets.extend(list(y))
+        # Distance.dist already works row by row on whole batches, keep the result on the device until 'get'
+        self.similarity.append(-self.distance.dist(embeddings1, embeddings2).detach())
+        self.targets.append(np.asarray(y))
+
+    def scores(self):
+        """
+        :return: a 1D array with the similarities accumulated since the last call to 'get'
+        """
+        return torch.cat(self.similarity).cpu().numpy()
 
     def get(self):
-        metric = spearmanr(self.similarity, self.targets)[0]
+        metric = spearman(self.scores(), np.concatenate(self.targets))
         self.similarity, self.targets = [], []
         return metric
 
@@ -155,16 +185,11 @@ class SpeakerVerificationEvaluator(base.TrainingListener):
         self.callbacks = callbacks if callbacks is not None else []
         self.best_metric, self.best_epoch = 0, -1
 
-    def _file_embedding(self, file_dict: dict, sequence_embedding: SequenceEmbedding, cache: dict):
-        file1 = file_dict
-        f_hash = self.get_hash(file1)
-        if f_hash in cache:
-            emb = cache[f_hash]
-        else:
-            emb = sequence_embedding.crop(file1, file1['try_with'])
-            emb = np.mean(np.stack(emb), axis=0, keepdims=True)
-            cache[f_hash] = emb
-        return emb
+    @staticmethod
+    def _file_embedding(file_dict: dict, sequence_embedding: SequenceEmbedding):
+        emb = sequence_embedding.crop(file_dict, file_dict['try_with'])
+        # asarray doesn't copy if crop already returns an array
+        return np.asarray(emb).mean(axis=0, keepdims=True)
 
     def eval(self, model, partition: str = 'development'):
         model.eval()
@@ -176,19 +201,23 @@ class SpeakerVerificationEvaluator(base.TrainingListener):
                                                device=common.DEVICE)
         protocol = get_protocol(self.config.protocol_name, progress=False, preprocessors=self.config.preprocessors)
 
-        y_true, y_pred, cache = [], [], {}
+        y_true, hashes1, hashes2, files = [], [], [], {}
 
+        # List the trials and the unique files they need
         for trial in getattr(protocol, f"{partition}_trial")():
+            for file_key, hashes in [('file1', hashes1), ('file2', hashes2)]:
+                f_hash = self.get_hash(trial[file_key])
+                files.setdefault(f_hash, trial[file_key])
+                hashes.append(f_hash)
+            y_true.append(trial['reference'])
 
-            # Compute embeddings
-            emb1 = self._file_embedding(trial['file1'], sequence_embedding, cache)
-            emb2 = self._file_embedding(trial['file2'], sequence_embedding, cache)
-
-            # Compare embeddings
-            dist = cdist(emb1, emb2, metric=self.distance.to_sklearn_metric())[0, 0]
+        # Compute embeddings, exactly once per unique file
+        cache = {f_hash: self._file_embedding(file, sequence_embedding) for f_hash, file in files.items()}
 
-            y_pred.append(dist)
-            y_true.append(trial['reference'])
+        # Compare the embeddings of every trial at once
+        emb1 = torch.from_numpy(np.vstack([cache[h] for h in hashes1])).to(common.DEVICE)
+        emb2 = torch.from_numpy(np.vstack([cache[h] for h in hashes2])).to(common.DEVICE)
+        y_pred = self.distance.paired_dist(emb1, emb2).cpu().numpy()
 
         _, _, _, eer = det_curve(np.array(y_true), np.array(y_pred), distances=True)
 
@@ -214,13 +243,14 @@ class SpeakerVerificationEvaluator(base.TrainingListener):
 
 class ClassAccuracyEvaluator(base.TrainingListener):
 
-    def __init__(self, device, loader, metric, callbacks=None):
+    def __init__(self, device, loader, metric, callbacks=None, mixed_precision: bool = False):
         super(ClassAccuracyEvaluator, self).__init__()
         self.device = device
+        self.mixed_precision = mixed_precision
         self.loader = loader
         self.metric = metric
         self.callbacks = callbacks if callbacks is not None else []
-        self.feat_train, self.y_train = None, None
+        self.feat_train, self.y_train, self.ntrain = None, None, 0
         self.best_metric, self.best_epoch = 0, -1
 
     def _eval(self, model):
@@ -228,7 +258,7 @@ class ClassAccuracyEvaluator(base.TrainingListener):
         feat_test, logits_test, y_test = [], [], []
         for cb in self.callbacks:
             cb.on_before_test()
-        with torch.no_grad():
+        with torch.no_grad(), eval_autocast(self.device, self.mixed_precision):
             for i in range(self.loader.nbatches()):
                 x, y = next(self.loader)
 
@@ -239,32 +269,56 @@ class ClassAccuracyEvaluator(base.TrainingListener):
 
                 # Feed Forward
                 feat, logits = model(x, y)
-                feat = feat.detach().cpu().numpy()
-                logits = logits.detach().cpu().numpy()
-                y = y.detach().cpu().numpy()
 
-                # Track accuracy
+                # Keep outputs on the device, they're transferred all at once at the end
                 feat_test.append(feat)
                 logits_test.append(logits)
                 y_test.append(y)
-                self.metric.calculate_batch(feat, logits, y)
 
                 for cb in self.callbacks:
                     cb.on_batch_tested(i, feat)
 
-        feat_test, y_test = np.concatenate(feat_test), np.concatenate(y_test)
+        feat_test = torch.cat(feat_test).float().cpu().numpy()
+        logits_test = torch.cat(logits_test).float().cpu().numpy() if logits_test[0] is not None else None
+        y_test = torch.cat(y_test).cpu().numpy()
+        # Track accuracy
+        self.metric.calculate_batch(feat_test, logits_test, y_test)
         return feat_test, y_test
 
+    @staticmethod
+    def _reserve(buffer, used: int, needed: int, like: np.ndarray):
+        """
+        Make sure a buffer can hold a given number of rows
+        :param buffer: the current buffer, or None
+        :param used: the number of rows already written to the buffer
+        :param needed: the number of rows the buffer needs to hold
+        :param like: an array with the shape (except for the first dimension) and dtype of the rows
+        :return: the same buffer if it's big enough, otherwise a bigger one containing the used rows
+        """
+        if buffer is not None and buffer.shape[0] >= needed:
+            return buffer
+        capacity = needed if buffer is None else max(needed, 2 * buffer.shape[0])
+        grown = np.empty((capacity,) + like.shape[1:], dtype=like.dtype)
+        if buffer is not None:
+            grown[:used] = buffer[:used]
+        return grown
+
     def on_before_epoch(self, epoch):
-        self.feat_train, self.y_train = [], []
+        # Buffers are kept between epochs, so they only grow during the first one
+        self.ntrain = 0
 
     def on_after_gradients(self, epoch, ibatch, feat, logits, y, loss):
-        self.feat_train.append(feat.detach().cpu().numpy())
-        self.y_train.append(y.detach().cpu().numpy())
+        feat, y = feat.detach().cpu().numpy(), y.detach().cpu().numpy()
+        start, end = self.ntrain, self.ntrain + feat.shape[0]
+        self.feat_train = self._reserve(self.feat_train, start, end, feat)
+        self.y_train = self._reserve(self.y_train, start, end, y)
+        self.feat_train[start:end] = feat
+        self.y_train[start:end] = y
+        self.ntrain = end
 
     def on_after_epoch(self, epoch, model, loss_fn, optim):
-        feat_train = np.concatenate(self.feat_train)
-        y_train = np.concatenate(self.y_train)
+        feat_train = self.feat_train[:self.ntrain]
+        y_train = self.y_train[:self.ntrain]
         self.metric.fit(feat_train, y_train)
         feat_test, y_test = self._eval(model)
         metric_value = self.metric.get()
@@ -285,9 +339,10 @@ class ClassAccuracyEvaluator(base.TrainingListener):
 
 class STSEmbeddingEvaluator(base.TrainingListener):
 
-    def __init__(self, device, loader, metric, callbacks=None):
+    def __init__(self, device, loader, metric, callbacks=None, mixed_precision: bool = False):
         super(STSEmbeddingEvaluator, self).__init__()
         self.device = device
+        self.mixed_precision = mixed_precision
         self.loader = loader
         self.metric = metric
         self.callbacks = callbacks if callbacks is not None else []
@@ -295,10 +350,10 @@ class STSEmbeddingEvaluator(base.TrainingListener):
 
     def eval(self, model):
         model.eval()
-        phrases, feat_test, y_test = [], [], []
+        phrases, feat_test, feat1_test, feat2_test, y_test = [], [], [], [], []
         for cb in self.callbacks:
             cb.on_before_test()
-        with torch.no_grad():
+        with torch.no_grad(), eval_autocast(self.device, self.mixed_precision):
             for i in range(self.loader.nbatches()):
                 x, y = next(self.loader)
 
@@ -307,28 +362,26 @@ class STSEmbeddingEvaluator(base.TrainingListener):
                 for pair in x:
                     phrases.append(' '.join([word for word in pair[1] if word != 'null']))
 
-                if isinstance(y, torch.Tensor):
-                    y = y.to(common.DEVICE)
-
                 # Feed Forward
                 feat = model(x)
 
                 # In evaluation mode, we always receive 2 phrases and no logits
-                feat1 = feat[0].detach().cpu().numpy()
-                feat2 = feat[1].detach().cpu().numpy()
-                y = y.detach().cpu().numpy()
+                feat1, feat2 = feat
 
-                # Track accuracy
+                # Keep embeddings on the device, they're transferred all at once at the end
                 feat_test.append(feat1)
                 feat_test.append(feat2)
+                feat1_test.append(feat1)
+                feat2_test.append(feat2)
                 y_test.append(y)
-                self.metric.calculate_batch(feat, None, y)
 
                 for cb in self.callbacks:
                     cb.on_batch_tested(i, feat)
 
-        feat_test = np.concatenate(feat_test)
-        y_test = np.concatenate(y_test)
+        y_test = torch.cat(y_test).numpy()
+        # Track accuracy
+        self.metric.calculate_batch((torch.cat(feat1_test).float(), torch.cat(feat2_test).float()), None, y_test)
+        feat_test = torch.cat(feat_test).float().cpu().numpy()
         return phrases, feat_test, y_test
 
     def on_after_epoch(self, epoch, model, loss_fn, optim):
@@ -351,9 +404,10 @@ class STSEmbeddingEvaluator(base.TrainingListener):
 
 class STSBaselineEvaluator(base.TrainingListener):
 
-    def __init__(self, device, loader, metric, callbacks=None):
+    def __init__(self, device, loader, metric, callbacks=None, mixed_precision: bool = False):
         super(STSBaselineEvaluator, self).__init__()
         self.device = device
+        self.mixed_precision = mixed_precision
         self.loader = loader
         self.metric = metric
         self.callbacks = callbacks if callbacks is not None else []
@@ -364,7 +418,7 @@ class STSBaselineEvaluator(base.TrainingListener):
         phrases, feat_test, logits_test, y_test = [], [], [], []
         for cb in self.callbacks:
             cb.on_before_test()
-        with torch.no_grad():
+        with torch.no_grad(), eval_autocast(self.device, self.mixed_precision):
             for i in range(self.loader.nbatches()):
                 x, y = next(self.loader)
 
@@ -373,28 +427,23 @@ class STSBaselineEvaluator(base.TrainingListener):
                 for pair in x:
                     phrases.append(' '.join([word for word in pair[1] if word != 'null']))
 
-                if isinstance(y, torch.Tensor):
-                    y = y.to(common.DEVICE)
-
                 # Feed Forward
                 feat, logits = model(x, y)
 
+                # Keep outputs on the device, they're transferred all at once at the end
                 feat1, feat2 = torch.split(feat, feat.size(1) // 2, dim=1)
-                feat1, feat2 = feat1.detach().cpu().numpy(), feat2.detach().cpu().numpy()
-                logits = logits.detach().cpu().numpy()
-                y = y.detach().cpu().numpy()
-
-                # Track accuracy
                 feat_test.append(feat1)
                 feat_test.append(feat2)
                 logits_test.append(logits)
                 y_test.append(y)
-                self.metric.calculate_batch(feat, logits, y)
 
                 for cb in self.callbacks:
                     cb.on_batch_tested(i, feat)
 
-        feat_test, y_test = np.concatenate(feat_test), np.concatenate(y_test)
+        feat_test = torch.cat(feat_test).float().cpu().numpy()
+        y_test = torch.cat(y_test).numpy()
+        # Track accuracy
+        self.metric.calculate_batch(None, torch.cat(logits_test).float().cpu().numpy(), y_test)
         return phrases, feat_test, y_test
 
     def on_after_epoch(self, epoch, model, loss_fn, optim):
@@ -1,5 +1,6 @@
 import numpy as np
 import math
+import torch
 from sts import utils
 from tqdm import tqdm
 
@@ -203,13 +204,17 @@ class SemiHardOfflineTripletSampling(OfflineTripletSampling):
         self.deviation = deviation
 
     def sample(self, triplets: list):
-        result = []
-        for a, p, n in triplets:
-            emb_a, emb_n = self.model(a), self.model(n)
+        triplets = list(triplets)
+        if not triplets:
+            return []
+        anchors, _, negatives = zip(*triplets)
+        # Embed every anchor and every negative in a single call each
+        with torch.no_grad():
+            emb_a, emb_n = self.model(list(anchors)), self.model(list(negatives))
             dist = self.distance.dist(emb_a, emb_n)
-            if self.m >= dist[0] or self.deviation >= dist[0] - self.m:
-                result.append((a, p, n))
-        return result
+        # Keep semi-hard triplets, reading the selection back only once
+        keep = ((dist <= self.m) | (dist - self.m <= self.deviation)).nonzero(as_tuple=True)[0].tolist()
+        return [triplets[i] for i in keep]
 
 
 class KeepAllOfflineTripletSampling(OfflineTripletSampling):
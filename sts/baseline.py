@@ -1,6 +1,6 @@
-from torch.autograd import Variable
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 import numpy
 from sts.modes import STSForwardMode
 
@@ -17,26 +17,38 @@ class STSBaselineNet(nn.Module):
         if 'oov' not in tokens:
             tokens.append('oov')
         self.word2id = {word: index for index, word in enumerate(tokens)}
+        # Single-probe word lookup falling back to the 'oov' token
+        self._word_id, self._oov_id = self.word2id.get, self.word2id['oov']
         # This loads the pretrained embeddings into the Embedding object which will be learned
         self.word_embedding = nn.Embedding(len(tokens), nfeat_word)
-        pretrained_weight = numpy.zeros(shape=(len(tokens), nfeat_word))
-        for i, word in enumerate(tokens):
-            pretrained_weight[i] = vec_vocab[word].numpy()
-        self.word_embedding.weight.data.copy_(torch.from_numpy(pretrained_weight))
+        # An 'oov' token missing from the vocabulary starts as a null vector
+        pretrained_weight = torch.stack([vec_vocab[word] if word in vec_vocab else torch.zeros(nfeat_word)
+                                         for word in tokens], dim=0)
+        self.word_embedding.weight.data.copy_(pretrained_weight)
         self.lstm = nn.LSTM(input_size=nfeat_word, hidden_size=nfeat_sent // 2,
                             num_layers=1, bidirectional=True)
 
-    def _to_word_embeddings(self, sent):
-        word_ids = [self.word2id[word] if word in self.word2id else self.word2id['oov'] for word in sent]
-        indices = Variable(torch.LongTensor(word_ids)).to(self.device)
-        embedded_sent = self.word_embedding(indices)
-        return embedded_sent.view(-1, 1, self.nfeat_word)
+    def _to_word_ids(self, sent):
+        word_id, oov = self._word_id, self._oov_id
+        word_ids = numpy.fromiter((word_id(word, oov) for word in sent), dtype=numpy.int64, count=len(sent))
+        return torch.from_numpy(word_ids)
 
-    def _embed(self, sent):
-        x = self._to_word_embeddings(sent)
+    def _embed(self, sents):
+        """
+        Embed a batch of sentences with a single LSTM pass
+        :param sents: a list of B sentences, each of them a list of words
+        :return: a tensor of shape (B, nfeat_sent)
+        """
+        lengths = torch.tensor([len(sent) for sent in sents])
+        max_length = int(lengths.max())
+        # Padded word ids of shape (T, B)
+        word_ids = pad_sequence([self._to_word_ids(sent) for sent in sents]).to(self.device, non_blocking=True)
+        x = pack_padded_sequence(self.word_embedding(word_ids), lengths, enforce_sorted=False)
         out, _ = self.lstm(x)
-        # Max pooling to get the embedding
-        return torch.max(out, 0)[0]
+        out, _ = pad_packed_sequence(out)
+        # Max pooling to get the embedding, ignoring padding positions
+        pad_mask = torch.arange(max_length, device=out.device)[:, None] >= lengths.to(out.device)[None, :]
+        return out.masked_fill(pad_mask.unsqueeze(-1), float('-inf')).amax(dim=0)
 
     def forward(self, sents):
         return self.mode.forward(self._embed, sents, self.training)
@@ -2,10 +2,35 @@ import torch
 
 
 class STSForwardMode:
+    """
+    A strategy to forward a batch of STS examples
+    `embed_fn` embeds a list of B sentences into a tensor of shape (B, D)
+    """
 
     @staticmethod
-    def stack(embeddings: list):
-        return torch.stack(embeddings, dim=0).squeeze()
+    def embed_unique(embed_fn, sents: list):
+        """
+        Embed a list of sentences, forwarding repeated sentences only once
+        :return: a tensor of shape (B, D)
+        """
+        keys = [tuple(sent) for sent in sents]
+        index, unique = {}, []
+        for key, sent in zip(keys, sents):
+            if key not in index:
+                index[key] = len(unique)
+                unique.append(sent)
+        embs = embed_fn(unique)
+        if len(unique) == len(sents):
+            return embs
+        return embs[torch.tensor([index[key] for key in keys], device=embs.device)]
+
+    def embed_tuples(self, embed_fn, sents: list):
+        """
+        Embed every sentence of a batch of k-tuples with a single call to `embed_fn`
+        :return: a tensor of shape (B, k, D)
+        """
+        embs = self.embed_unique(embed_fn, [sent for group in sents for sent in group])
+        return embs.view(len(sents), -1, embs.size(1))
 
     def forward(self, embed_fn, sents: list, train: bool):
         raise NotImplementedError
@@ -14,18 +39,15 @@ class STSForwardMode:
 class ConcatSTSForwardMode(STSForwardMode):
 
     def forward(self, embed_fn, sents: list, train: bool):
-        embs = [torch.cat((embed_fn(s1), embed_fn(s2)), 1) for s1, s2 in sents]
-        return self.stack(embs)
+        embs = self.embed_tuples(embed_fn, sents)
+        return embs.view(embs.size(0), -1)
 
 
 class PairSTSForwardMode(STSForwardMode):
 
     def forward(self, embed_fn, sents: list, train: bool):
-        embs1, embs2 = [], []
-        for s1, s2 in sents:
-            embs1.append(embed_fn(s1))
-            embs2.append(embed_fn(s2))
-        return self.stack(embs1), self.stack(embs2)
+        embs = self.embed_tuples(embed_fn, sents)
+        return embs[:, 0], embs[:, 1]
 
 
 class TripletSTSForwardMode(STSForwardMode):
@@ -35,12 +57,8 @@ class TripletSTSForwardMode(STSForwardMode):
 
     def forward(self, embed_fn, sents: list, train: bool):
         if train:
-            embs_anchor, embs_pos, embs_neg = [], [], []
-            for anchor, pos, neg in sents:
-                embs_anchor.append(embed_fn(anchor))
-                embs_pos.append(embed_fn(pos))
-                embs_neg.append(embed_fn(neg))
-            return self.stack(embs_anchor), self.stack(embs_pos), self.stack(embs_neg)
+            embs = self.embed_tuples(embed_fn, sents)
+            return embs[:, 0], embs[:, 1], embs[:, 2]
         else:
             return self.eval_mode.forward(embed_fn, sents, train)
 
@@ -52,8 +70,7 @@ class SingleSTSForwardMode(STSForwardMode):
 
     def forward(self, embed_fn, sents: list, train: bool):
         if train:
-            embs = [embed_fn(sent) for sent in sents]
-            return self.stack(embs)
+            return self.embed_unique(embed_fn, sents)
         else:
             return self.eval_mode.forward(embed_fn, sents, train)
 